@@ -1,14 +1,28 @@
 import os
+import pathlib
 import asyncio
-import nest_asyncio
+import atexit
+import concurrent.futures
+import hashlib
+import queue
+import threading
+import time
+import uuid
 import streamlit as st
 import json
-import pandas as pd
+import orjson
+import fastjsonschema
+import ijson
+import aiohttp
 import logging
-import re  # Import regex for JSON extraction
+import logging.handlers
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import AsyncExitStack, contextmanager
 from azure.identity.aio import ClientSecretCredential # DefaultAzureCredential removed as ClientSecretCredential is used directly
 from azure.core.exceptions import ClientAuthenticationError, HttpResponseError
-from semantic_kernel.agents import AzureAIAgent, AzureAIAgentSettings # AzureAIAgentThread removed as it's not used
+from azure.core.pipeline.transport import AioHttpTransport
+from semantic_kernel.agents import AzureAIAgent, AzureAIAgentSettings, AzureAIAgentThread
 from azure.identity import ClientSecretCredential as SyncClientSecretCredential
 from azure.ai.projects import AIProjectClient
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -26,303 +40,886 @@ from opentelemetry.trace import Status, StatusCode
 # AZURE_TENANT_ID = "your_tenant_id"
 # AZURE_CLIENT_ID = "your_client_id"
 # AZURE_CLIENT_SECRET = "your_client_secret"
-# LOG_LEVEL = "INFO" # Optional: Set to DEBUG for more verbose logs
+# Verbose logging is enabled with the HARMATTAN_DEBUG environment variable (see Logging below)
+# and profiling of the analysis with HARMATTAN_PROFILE (requires pyinstrument, see profile_analysis).
+# HARMATTAN_KEEPALIVE_PING_INTERVAL keeps the agent connection warm (see AGENT_KEEPALIVE_PING_INTERVAL).
 
-AGENT_ID = st.secrets.azure.AZURE_AI_AGENT_AGENT
-os.environ["AZURE_AI_AGENT_PROJECT_CONNECTION_STRING"] = st.secrets.azure.AZURE_AI_AGENT_PROJECT_CONNECTION_STRING
-os.environ["AZURE_AI_AGENT_MODEL_DEPLOYMENT_NAME"] = st.secrets.azure.AZURE_AI_AGENT_MODEL_DEPLOYMENT_NAME
-# Assurez-vous aussi d’avoir défini AZURE_AI_AGENT_ENDPOINT dans vos secrets
-os.environ["AZURE_AI_PROJECT_ENDPOINT"] = st.secrets.azure.AZURE_AI_PROJECT_ENDPOINT
+@st.cache_resource(show_spinner=False)
+def _load_secrets() -> str:
+    """
+    Exports the agent settings from the secrets once per process and returns the agent ID.
+    Streamlit reruns the script on every interaction; the secrets don't change between runs.
+    """
+    secrets = st.secrets.azure
+    os.environ["AZURE_AI_AGENT_PROJECT_CONNECTION_STRING"] = secrets.AZURE_AI_AGENT_PROJECT_CONNECTION_STRING
+    os.environ["AZURE_AI_AGENT_MODEL_DEPLOYMENT_NAME"] = secrets.AZURE_AI_AGENT_MODEL_DEPLOYMENT_NAME
+    # Assurez-vous aussi d’avoir défini AZURE_AI_AGENT_ENDPOINT dans vos secrets
+    os.environ["AZURE_AI_PROJECT_ENDPOINT"] = secrets.AZURE_AI_PROJECT_ENDPOINT
+    return secrets.AZURE_AI_AGENT_AGENT
 
 
-import logging
+AGENT_ID = _load_secrets()
 
-# — NEW LOGGING CONFIG — 
 
-# 1) Configure the **root** logger to only record INFO+ (so DEBUG/VERBOSE is dropped immediately):
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    filename="debug.log",
-    filemode="w",
-)
+# --- Logging ---
 
-# 2) Now create your module‐level logger so you can still call `logger.debug(...)` if you want:
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+# Set HARMATTAN_DEBUG=1 to record DEBUG messages and write them to debug.log
+DEBUG_LOGGING = os.getenv("HARMATTAN_DEBUG", "").lower() in ("1", "true", "yes")
+# Set HARMATTAN_PROFILE=1 to profile each analysis and show the report in the sidebar (development only)
+PROFILE_ANALYSIS = os.getenv("HARMATTAN_PROFILE", "").lower() in ("1", "true", "yes")
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DEBUG_LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate debug.log past 10 MB, keeping 3 backups
+DEBUG_LOG_BACKUP_COUNT = 3
 
-# 3) Quiet down other noisy libraries at WARNING+ only:
-for lib in ("azure", "opentelemetry", "httpx", "urllib3"):
-    logging.getLogger(lib).setLevel(logging.ERROR)
 
-# 4) (Optional) Re-attach a console handler for INFO+ to stdout:
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-console.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logging.getLogger().addHandler(console)
+@st.cache_resource(show_spinner=False)
+def _configure_logging() -> None:
+    """
+    Configures logging once per process.
 
+    Streamlit re-executes this script on every interaction, so handlers must not be
+    attached at module level. The console is the only sink by default; in debug mode
+    records are also written to debug.log by a background QueueListener, so file I/O
+    never blocks the request path.
+    """
+    handlers = [logging.StreamHandler()]
+    if DEBUG_LOGGING:
+        # Append so a restart keeps the previous run's records; rotation bounds the file size
+        file_handler = logging.handlers.RotatingFileHandler(
+            "debug.log", maxBytes=DEBUG_LOG_MAX_BYTES, backupCount=DEBUG_LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # The file handler applies LOG_FORMAT; only merge the message arguments here
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(queue_handler)
+
+    logging.basicConfig(level=logging.DEBUG if DEBUG_LOGGING else logging.INFO, format=LOG_FORMAT, handlers=handlers)
+
+    # Quiet down other noisy libraries at ERROR+ only:
+    for lib in ("azure", "opentelemetry", "httpx", "urllib3"):
+        logging.getLogger(lib).setLevel(logging.ERROR)
+
+
+_configure_logging()
+logger = logging.getLogger(__name__)
 
 
 # --- Azure AI Foundry Telemetry Initialization ---
-try:
-    endpoint       = st.secrets.azure.AZURE_AI_PROJECT_ENDPOINT
-    subscription   = st.secrets.azure.AZURE_SUBSCRIPTION_ID
-    resource_group = st.secrets.azure.AZURE_RESOURCE_GROUP_NAME
-    project_name   = st.secrets.azure.AZURE_AI_PROJECT_NAME
-    tenant_id      = st.secrets.azure.AZURE_TENANT_ID
-    client_id      = st.secrets.azure.AZURE_CLIENT_ID
-    client_secret  = st.secrets.azure.AZURE_CLIENT_SECRET
-
-    # Sauter uniquement si les secrets essentiels manquent
-    if not all([endpoint, subscription, resource_group, project_name, tenant_id, client_id, client_secret]):
-        logger.warning("⚠️ Secrets Azure Foundry incomplets ; télémétrie désactivée.")
-    else:
-        creds_sync = SyncClientSecretCredential(
-            tenant_id=tenant_id,
-            client_id=client_id,
-            client_secret=client_secret,
-        )
-        project_client = AIProjectClient(
-            endpoint=endpoint,
-            subscription_id=subscription,
-            resource_group_name=resource_group,
-            project_name=project_name,
-            credential=creds_sync
-        )
-        try:
-            ai_conn_str = project_client.telemetry.get_connection_string()
-            if ai_conn_str:
-                os.environ["AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED"] = "true"
-                configure_azure_monitor(connection_string=ai_conn_str)
-                logger.info("✅ Télémétrie Azure AI Foundry configurée.")
-            else:
-                logger.warning("⚠️ Pas de ressource App Insights liée ; télémétrie désactivée.")
-        except ClientAuthenticationError:
-            logger.warning("⚠️ Permissions insuffisantes pour la télémétrie Foundry ; ignore.")
-except Exception as ex:
-    logger.error(f"Erreur d’initialisation de la télémétrie : {ex}", exc_info=True)
 
+# Share of traces exported to Application Insights (head-based sampling, 1.0 keeps every trace)
+TELEMETRY_SAMPLING_RATIO = 0.1
 
-tracer = trace.get_tracer("HarmattanAI")
 
+@st.cache_resource(show_spinner=False)
+def _init_telemetry() -> None:
+    """
+    Connects OpenTelemetry to the project's Application Insights once per process.
+
+    Fetching the connection string is a blocking ARM call, so it must not run on
+    every rerun of the script.
+    """
+    try:
+        endpoint       = st.secrets.azure.AZURE_AI_PROJECT_ENDPOINT
+        subscription   = st.secrets.azure.AZURE_SUBSCRIPTION_ID
+        resource_group = st.secrets.azure.AZURE_RESOURCE_GROUP_NAME
+        project_name   = st.secrets.azure.AZURE_AI_PROJECT_NAME
+        tenant_id      = st.secrets.azure.AZURE_TENANT_ID
+        client_id      = st.secrets.azure.AZURE_CLIENT_ID
+        client_secret  = st.secrets.azure.AZURE_CLIENT_SECRET
+
+        # Sauter uniquement si les secrets essentiels manquent
+        if not all([endpoint, subscription, resource_group, project_name, tenant_id, client_id, client_secret]):
+            logger.warning("⚠️ Secrets Azure Foundry incomplets ; télémétrie désactivée.")
+        else:
+            # The sync credential and client are only needed for this one lookup: close them right after
+            with SyncClientSecretCredential(
+                tenant_id=tenant_id,
+                client_id=client_id,
+                client_secret=client_secret,
+            ) as creds_sync, AIProjectClient(
+                endpoint=endpoint,
+                subscription_id=subscription,
+                resource_group_name=resource_group,
+                project_name=project_name,
+                credential=creds_sync
+            ) as project_client:
+                try:
+                    ai_conn_str = project_client.telemetry.get_connection_string()
+                    if ai_conn_str:
+                        # Prompts and responses carry clinical notes: only record them in exported spans in debug mode
+                        os.environ["AZURE_TRACING_GEN_AI_CONTENT_RECORDING_ENABLED"] = "true" if DEBUG_LOGGING else "false"
+                        configure_azure_monitor(connection_string=ai_conn_str, sampling_ratio=TELEMETRY_SAMPLING_RATIO)
+                        logger.info("✅ Télémétrie Azure AI Foundry configurée.")
+                    else:
+                        logger.warning("⚠️ Pas de ressource App Insights liée ; télémétrie désactivée.")
+                except ClientAuthenticationError:
+                    logger.warning("⚠️ Permissions insuffisantes pour la télémétrie Foundry ; ignore.")
+    except Exception as ex:
+        logger.error("Erreur d’initialisation de la télémétrie : %s", ex, exc_info=True)
+
+
+_init_telemetry()
+tracer = trace.get_tracer("HarmattanAI")
 
-# Apply nest_asyncio to allow running asyncio code wi"thin Streamlit's event loop
-nest_asyncio.apply()
 
 # --- Azure AI Agent Interaction ---
 
 # Define a timeout for agent calls (in seconds)
 AGENT_CALL_TIMEOUT = 120.0  # 2 minutes
 
-async def run_agent(user_input: str) -> str | None:
+# Longest the script thread waits on the event loop for the next chunk (agent creation + first token)
+AGENT_STREAM_STALL_TIMEOUT = 2 * AGENT_CALL_TIMEOUT
+
+# Connection pool of the agent client's HTTP transport
+AGENT_HTTP_LIMIT = 32  # Shared by all sessions of the app
+AGENT_HTTP_LIMIT_PER_HOST = 16
+AGENT_HTTP_KEEPALIVE_TIMEOUT = 60.0  # Keep idle connections open between clicks
+AGENT_HTTP_DNS_CACHE_TTL = 600  # seconds
+AGENT_HTTP_HAPPY_EYEBALLS_DELAY = 0.1  # seconds before racing the next resolved address
+# Interval of the request that keeps a pooled connection warm; must stay below the keep-alive timeout.
+# Off by default since it calls the agent endpoint for as long as the server runs, users or not;
+# set HARMATTAN_KEEPALIVE_PING_INTERVAL (seconds, e.g. 55) to enable.
+AGENT_KEEPALIVE_PING_INTERVAL = float(os.getenv("HARMATTAN_KEEPALIVE_PING_INTERVAL", "0"))
+AGENT_HTTP_CONNECT_TIMEOUT = 3.0  # seconds
+AGENT_HTTP_READ_TIMEOUT = 60.0  # Max silence on a socket read, e.g. between streamed events
+AGENT_HTTP_RETRY_TOTAL = 1
+
+# Marks the end of a streamed agent response in the chunk queue
+_STREAM_END = object()
+
+
+class AgentCallError(Exception):
+    """Raised when the agent call fails. The message is safe to show in the UI."""
+
+
+@st.cache_resource(show_spinner=False)
+def _get_event_loop() -> asyncio.AbstractEventLoop:
     """
-    Connects to Azure, retrieves the specified agent, and gets a response.
+    Starts the event loop that owns the cached Azure credential and client.
+
+    The loop runs in a daemon thread for the lifetime of the process, so the
+    objects bound to it survive Streamlit reruns.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="azure-agent-loop", daemon=True).start()
+    return loop
+
+
+def _run_coroutine(coro, timeout: float | None = None):
+    """Runs a coroutine on the shared event loop and blocks until it completes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result(timeout)
+
+
+def _close_agent_resources(stack: AsyncExitStack, loop: asyncio.AbstractEventLoop) -> None:
+    """Closes the cached credential and client at interpreter shutdown."""
+    if not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(stack.aclose(), loop).result(timeout=5)
+    except Exception as e:
+        logger.warning("Error while closing Azure AI Agent resources: %s", e)
+
+
+async def _keep_connection_warm(client) -> None:
+    """
+    Periodically re-fetches the agent definition so a pooled connection to the
+    endpoint never sits idle past the keep-alive timeout.
+    """
+    while True:
+        await asyncio.sleep(AGENT_KEEPALIVE_PING_INTERVAL)
+        try:
+            await client.agents.get_agent(agent_id=AGENT_ID)
+        except Exception as e:
+            logger.debug("Keep-alive request to the agent endpoint failed: %s", e)
+
+
+async def _create_agent() -> AzureAIAgent:
+    """
+    Opens the Azure credential and AI client and retrieves the agent definition.
+
+    The credential, client and HTTP session are kept open on an exit stack so
+    that later requests reuse them; the stack is closed by an atexit hook.
+
+    Returns:
+        A reusable AzureAIAgent instance.
+    """
+    # Ensure all necessary secrets for ClientSecretCredential are present
+    if not all([st.secrets.azure.get("AZURE_TENANT_ID"),
+                st.secrets.azure.get("AZURE_CLIENT_ID"),
+                st.secrets.azure.get("AZURE_CLIENT_SECRET")]):
+        logger.error("Missing Azure credentials (TENANT_ID, CLIENT_ID, or CLIENT_SECRET) for AzureAIAgent.")
+        raise AgentCallError("Azure credentials for the AI Agent are not fully configured. Please check secrets.")
+
+    stack = AsyncExitStack()
+    try:
+        creds_async = await stack.enter_async_context(ClientSecretCredential(
+            tenant_id=st.secrets.azure.AZURE_TENANT_ID,
+            client_id=st.secrets.azure.AZURE_CLIENT_ID,
+            client_secret=st.secrets.azure.AZURE_CLIENT_SECRET,
+        ))
+        # Own the aiohttp session so its keep-alive pool is tuned and outlives each request
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=AGENT_HTTP_LIMIT,
+            limit_per_host=AGENT_HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=AGENT_HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=AGENT_HTTP_DNS_CACHE_TTL,
+            happy_eyeballs_delay=AGENT_HTTP_HAPPY_EYEBALLS_DELAY,
+        ))
+        stack.push_async_callback(session.close)
+        # azure-core sets a per-request aiohttp timeout, so the limits go on the transport, not the session
+        transport = AioHttpTransport(
+            session=session,
+            session_owner=False,
+            connection_timeout=AGENT_HTTP_CONNECT_TIMEOUT,
+            read_timeout=AGENT_HTTP_READ_TIMEOUT,
+        )
+        client = await stack.enter_async_context(AzureAIAgent.create_client(
+            credential=creds_async,
+            transport=transport,
+            retry_total=AGENT_HTTP_RETRY_TOTAL,
+        ))
+        logger.debug("Azure credentials and AI client created.")
+        settings = AzureAIAgentSettings.create()  # Uses env vars
+
+        # Retrieve the agent definition
+        logger.debug("Retrieving agent definition for %s...", AGENT_ID)
+        async with asyncio.timeout(AGENT_CALL_TIMEOUT):
+            agent_def = await client.agents.get_agent(agent_id=AGENT_ID)
+        logger.debug("Agent definition retrieved.")
+
+        if AGENT_KEEPALIVE_PING_INTERVAL > 0:
+            ping_task = asyncio.create_task(_keep_connection_warm(client))
+            stack.callback(ping_task.cancel)
+    except BaseException:
+        await stack.aclose()
+        raise
+
+    atexit.register(_close_agent_resources, stack, asyncio.get_running_loop())
+    agent = AzureAIAgent(client=client, definition=agent_def, settings=settings)
+    logger.info("AzureAIAgent instance created for agent %s.", AGENT_ID)
+    return agent
+
+
+@st.cache_resource(show_spinner=False)
+def _create_agent_future() -> concurrent.futures.Future:
+    """Schedules the agent creation once per process on the shared event loop."""
+    return asyncio.run_coroutine_threadsafe(_create_agent(), _get_event_loop())
+
+
+def get_agent_future() -> concurrent.futures.Future:
+    """
+    Returns the future of the cached agent.
+
+    A failed or cancelled creation is not kept in the cache, so the next request retries it.
+    """
+    future = _create_agent_future()
+    # exception() raises on a cancelled future, so check cancelled() first
+    if future.done() and (future.cancelled() or future.exception() is not None):
+        _create_agent_future.clear()
+        future = _create_agent_future()
+    return future
+
+
+async def _stream_response(
+    agent: AzureAIAgent,
+    user_input: str,
+    thread: AzureAIAgentThread | None,
+    on_chunk: Callable[[str], None],
+    span,
+) -> tuple[str, AzureAIAgentThread | None]:
+    """Streams the agent's answer, forwarding each text chunk to on_chunk."""
+    parts = []
+    async for chunk in agent.invoke_stream(messages=user_input, thread=thread):
+        # Only the assistant text is needed; str() would also format the message metadata
+        text = chunk.message.content
+        if text:
+            if not parts:
+                span.add_event("agent.first_chunk.received")
+            parts.append(text)
+            on_chunk(text)
+        thread = chunk.thread
+    return "".join(parts), thread
+
+
+async def run_agent(
+    user_input: str,
+    agent_future: concurrent.futures.Future,
+    thread: AzureAIAgentThread | None = None,
+    on_chunk: Callable[[str], None] = lambda text: None,
+) -> tuple[str, AzureAIAgentThread]:
+    """
+    Streams a response from the cached agent.
     Telemetry is captured for the agent interaction.
 
     Args:
         user_input: The text input from the user to send to the agent.
+        agent_future: Future resolving to the cached AzureAIAgent (see get_agent_future).
+        thread: The conversation thread to continue, or None to start a new one.
+        on_chunk: Called from the event loop thread with each chunk of text as it arrives.
 
     Returns:
-        The raw string response from the agent, or None if an error occurs.
+        The raw string response from the agent and the thread it belongs to.
+
+    Raises:
+        AgentCallError: If the agent could not be reached or failed to respond.
     """
     # Ensure the AGENT_ID corresponds to an agent definition compatible
     # with the expected input/output format of this application.
     with tracer.start_as_current_span("AI-Agent.run_agent") as span: # Changed '/' to '.' for potential naming convention consistency
         span.set_attribute("ai.agent_id", AGENT_ID)
         span.set_attribute("ai.timeout_seconds", AGENT_CALL_TIMEOUT)
-        span.set_attribute("ai.user_input_preview", user_input[:100]) # Add preview of input for context
+        if DEBUG_LOGGING:
+            span.set_attribute("ai.user_input_preview", user_input[:100]) # Add preview of input for context
+        span.set_attribute("ai.thread_reused", thread is not None)
 
-        logger.info(f"Attempting to run agent {AGENT_ID}...")
+        logger.info("Attempting to run agent %s...", AGENT_ID)
         try:
-            # Ensure all necessary secrets for ClientSecretCredential are present
-            if not all([st.secrets.azure.get("AZURE_TENANT_ID"),
-                        st.secrets.azure.get("AZURE_CLIENT_ID"),
-                        st.secrets.azure.get("AZURE_CLIENT_SECRET")]):
-                logger.error("Missing Azure credentials (TENANT_ID, CLIENT_ID, or CLIENT_SECRET) for AzureAIAgent.")
-                st.error("Azure credentials for the AI Agent are not fully configured. Please check secrets.")
-                span.set_status(Status(StatusCode.ERROR, "Missing Azure credentials for AI Agent"))
-                return None
-
-            creds_async = ClientSecretCredential(
-                tenant_id=st.secrets.azure.AZURE_TENANT_ID,
-                client_id=st.secrets.azure.AZURE_CLIENT_ID,
-                client_secret=st.secrets.azure.AZURE_CLIENT_SECRET,
-            )
-
-            async with creds_async, AzureAIAgent.create_client(credential=creds_async) as client:
-                logger.debug("Azure credentials and AI client created.")
-                settings = AzureAIAgentSettings.create()  # Uses env vars
-
-                # Retrieve the agent definition
-                logger.debug(f"Retrieving agent definition for {AGENT_ID}...")
-                agent_def = await asyncio.wait_for(
-                    client.agents.get_agent(agent_id=AGENT_ID),
-                    timeout=AGENT_CALL_TIMEOUT
-                )
-                logger.debug("Agent definition retrieved.")
-                span.add_event("agent.definition.retrieved")
-
-                # Create the agent instance
-                agent = AzureAIAgent(client=client, definition=agent_def, settings=settings)
-                logger.debug("AzureAIAgent instance created.")
-
-                # Get the agent's response
-                logger.info("Sending request to agent...")
-                response_content = None # Initialize response_content
-
-                # *** TELEMETRY FIX: Corrected duplicated call and added specific span for get_response ***
-                with tracer.start_as_current_span("AI-Agent.get_response") as rsp_span:
-                    rsp_span.set_attribute("ai.user_input_length", len(user_input))
-                    try:
-                        # Note: Verify the expected input format for `get_response`.
-                        # Some agent implementations might expect a list of message dicts,
-                        # e.g., messages=[{"role": "user", "content": user_input}]
-                        # Assuming user_input is the correct format for your agent.
-                        api_response = await asyncio.wait_for(
-                            agent.get_response(messages=user_input), # Single call to agent
-                            timeout=AGENT_CALL_TIMEOUT
-                        )
-                        response_content = str(api_response) # Convert to string
-                        rsp_span.set_attribute("ai.response_preview", api_response) # Add preview of response
-                        rsp_span.add_event("agent.get_response.succeeded")
-                        # Span status is OK by default if no exception
-                    except Exception as e_inner:
-                        logger.error(f"Error during agent.get_response: {e_inner}", exc_info=True)
-                        rsp_span.record_exception(e_inner)
-                        rsp_span.set_status(Status(StatusCode.ERROR, f"Agent get_response failed: {type(e_inner).__name__}"))
-                        raise # Re-raise to be caught by the outer try-except, which will mark the parent span
-
-                span.add_event("agent.response.processed") # Event for the outer span
-                logger.info("Received response from agent.")
-                logger.debug(f"Raw agent response: {response_content}")
-                # Set status OK for the outer span if we reached here successfully
-                span.set_status(Status(StatusCode.OK))
-                return response_content
-
+            # Shielded: cancelling this call must not cancel the agent creation shared by every session
+            agent = await asyncio.shield(asyncio.wrap_future(agent_future))
+            span.add_event("agent.definition.retrieved")
+
+            # Get the agent's response
+            logger.info("Sending request to agent...")
+            response_content = None # Initialize response_content
+
+            # *** TELEMETRY FIX: Corrected duplicated call and added specific span for get_response ***
+            with tracer.start_as_current_span("AI-Agent.get_response") as rsp_span:
+                rsp_span.set_attribute("ai.user_input_length", len(user_input))
+                try:
+                    # Note: Verify the expected input format for `invoke_stream`.
+                    # Some agent implementations might expect a list of message dicts,
+                    # e.g., messages=[{"role": "user", "content": user_input}]
+                    # Assuming user_input is the correct format for your agent.
+                    # A timeout scope rather than wait_for: the stream runs in this task instead of a wrapper task.
+                    # The agent future stays outside it so a slow call cannot cancel the shared agent creation.
+                    async with asyncio.timeout(AGENT_CALL_TIMEOUT):
+                        response_content, thread = await _stream_response(agent, user_input, thread, on_chunk, rsp_span)
+                    rsp_span.set_attribute("ai.response_length", len(response_content))
+                    rsp_span.add_event("agent.get_response.succeeded")
+                    # Span status is OK by default if no exception
+                except Exception as e_inner:
+                    logger.error("Error during agent.invoke_stream: %s", e_inner, exc_info=True)
+                    rsp_span.record_exception(e_inner)
+                    rsp_span.set_status(Status(StatusCode.ERROR, f"Agent get_response failed: {type(e_inner).__name__}"))
+                    raise # Re-raise to be caught by the outer try-except, which will mark the parent span
+
+            span.add_event("agent.response.processed") # Event for the outer span
+            logger.info("Received response from agent.")
+            logger.debug("Raw agent response: %s", response_content)
+            # Set status OK for the outer span if we reached here successfully
+            span.set_status(Status(StatusCode.OK))
+            return response_content, thread
+
+        except AgentCallError as e:
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
         except ClientAuthenticationError as e:
-            logger.error(f"Azure Authentication Error: {e}", exc_info=True)
-            st.error("Authentication failed. Please check Azure credentials configuration.")
+            logger.error("Azure Authentication Error: %s", e, exc_info=True)
             span.record_exception(e)
             span.set_status(Status(StatusCode.ERROR, "Azure Authentication Error"))
-            return None
+            raise AgentCallError("Authentication failed. Please check Azure credentials configuration.") from e
         except HttpResponseError as e:
-            logger.error(f"Azure API Error: Status={e.status_code}, Reason={e.reason}, Message={e.message}", exc_info=True)
-            st.error(f"An error occurred while communicating with the Azure AI service (Status: {e.status_code}). Please try again later.")
+            logger.error("Azure API Error: Status=%s, Reason=%s, Message=%s", e.status_code, e.reason, e.message, exc_info=True)
             span.record_exception(e)
             span.set_status(Status(StatusCode.ERROR, f"Azure API Error: {e.status_code}"))
             span.set_attribute("http.status_code", e.status_code) # Add http status code if available
-            return None
-        except asyncio.TimeoutError:
-            logger.error(f"Agent call timed out after {AGENT_CALL_TIMEOUT} seconds.")
-            st.error("The request to the AI agent timed out. Please try again.")
+            raise AgentCallError(f"An error occurred while communicating with the Azure AI service (Status: {e.status_code}). Please try again later.") from e
+        except asyncio.TimeoutError as e:
+            logger.error("Agent call timed out after %s seconds.", AGENT_CALL_TIMEOUT)
             # TimeoutError is an Exception, so record_exception will work.
             # Create a TimeoutError instance to pass to record_exception if not automatically available.
             timeout_exc = asyncio.TimeoutError(f"Agent call timed out after {AGENT_CALL_TIMEOUT} seconds.")
             span.record_exception(timeout_exc)
             span.set_status(Status(StatusCode.ERROR, "Agent call timed out"))
-            return None
+            raise AgentCallError("The request to the AI agent timed out. Please try again.") from e
         except Exception as e:
-            logger.error(f"Unexpected error during agent interaction: {e}", exc_info=True)
-            # Show the actual exception text in the UI
-            st.error(f"An unexpected error occurred: {e}")
+            logger.error("Unexpected error during agent interaction: %s", e, exc_info=True)
             span.record_exception(e)
             span.set_status(Status(StatusCode.ERROR, f"Unexpected error: {type(e).__name__}"))
-            return None
+            # Show the actual exception text in the UI
+            raise AgentCallError(f"An unexpected error occurred: {e}") from e
 
 
-def extract_json_from_string(text: str) -> str | None:
+# Markdown code fence the agent may wrap its answer in
+_FENCE = "```"
+# Parses a JSON value embedded in other text in place, without backtracking
+_JSON_DECODER = json.JSONDecoder()
+
+def decode_json_from_string(text: str) -> list | dict | None:
     """
-    Extracts JSON content potentially wrapped in markdown code fences.
+    Decodes the JSON content of the agent's response, potentially wrapped in markdown code fences.
+    The JSON is parsed where it lies in the response instead of being sliced out and parsed again.
 
     Args:
         text: The string potentially containing JSON.
 
     Returns:
-        The extracted JSON string, or None if no JSON object/array is found.
+        The decoded JSON object or array, or None if no JSON object/array is found.
+
+    Raises:
+        json.JSONDecodeError: If the JSON found in the response is invalid
+            (orjson.JSONDecodeError is a subclass).
     """
     if not text: # Handle empty or None input
         logger.warning("Input text for JSON extraction is empty or None.")
         return None
-    # Regex to find JSON object '{...}' or array '[...]' potentially wrapped in ```json ... ```
-    # It handles potential leading/trailing whitespace and the markdown fences.
-    match = re.search(r'```(?:json)?\s*([\[\{].*[\]\}])\s*```|([\[\{].*[\]\}])', text, re.DOTALL | re.IGNORECASE)
-    if match:
-        # Return the first non-None captured group
-        json_str = match.group(1) if match.group(1) else match.group(2)
-        logger.debug(f"Extracted JSON string: {json_str[:200]}...") # Log preview
-        return json_str
+    # Common case: the response is bare JSON, parsed in one pass without scanning for fences
+    stripped = text.strip()
+    if stripped[:1] in ("[", "{"):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass # e.g. prose after the JSON: located by the decoder below
+    # Next: the whole response is a single ```json fence, unwrapped by its prefix and suffix
+    if len(stripped) >= 2 * len(_FENCE) and stripped.startswith(_FENCE) and stripped.endswith(_FENCE):
+        body = stripped[len(_FENCE):-len(_FENCE)]
+        if body[:4].lower() == "json":
+            body = body[4:]
+        body = body.strip()
+        if body[:1] in ("[", "{"):
+            logger.debug("Decoding fenced JSON: %.200s...", body) # Log preview
+            try:
+                return orjson.loads(body)
+            except orjson.JSONDecodeError:
+                pass # e.g. two fences or text between them: located by the decoder below
+    # Otherwise the JSON object '{...}' or array '[...]' starts at the first bracket,
+    # e.g. after prose or inside a fence followed by more text; the decoder parses it in place.
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if starts:
+        start = min(starts)
+        logger.debug("Decoding embedded JSON: %.200s...", text[start:start + 200]) # Log preview
+        data, _ = _JSON_DECODER.raw_decode(text, start)
+        return data
     logger.warning("Could not find JSON object or array in the agent's response.")
-    logger.debug(f"Full text searched for JSON: {text[:500]}...") # Log preview of text that failed extraction
+    logger.debug("Full text searched for JSON: %.500s...", text) # Log preview of text that failed extraction
     return None
 
-async def get_agent_response_async(user_input: str) -> list | None:
+# Expected shape of the agent's answer, compiled once at import
+_validate_results = fastjsonschema.compile({
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": ["extract", "code"],
+        "properties": {
+            "extract": {"type": "string"},
+            "description": {"type": ["string", "null"]},
+            "code": {"type": "string"},
+            "url": {"type": ["string", "null"]},
+        },
+    },
+})
+
+def parse_agent_response(raw_response: str) -> list | None:
     """
-    Runs the agent, parses the JSON response, and handles errors.
+    Parses the agent's raw response into a list and reports errors in the UI.
     Telemetry for the raw agent call is handled within run_agent.
-    This function focuses on parsing and could have its own span if complex.
 
     Args:
-        user_input: The text input from the user.
+        raw_response: The raw string response returned by run_agent.
 
     Returns:
         A list containing the parsed data from the agent, or None if an error occurs.
     """
-    # Consider adding a span here if parsing logic is complex or error-prone
     with tracer.start_as_current_span("App.parse_agent_response") as parse_span:
-        raw_response = await run_agent(user_input)
-        if raw_response is None:
-            parse_span.set_status(Status(StatusCode.ERROR, "Agent returned no response")) # If span added
-            return None  # Error already handled and logged in run_agent
-
-    json_string = extract_json_from_string(raw_response)
-    if json_string is None:
-        st.error("Could not extract valid JSON data from the agent's response.")
-        logger.error(f"Failed to extract JSON from raw response: {raw_response}")
-        parse_span.set_status(Status(StatusCode.ERROR, "JSON extraction failed")) # If span added
-        parse_span.set_attribute("app.raw_response_preview", raw_response[:200]) # If span added
-        return None
-
-    try:
-        logger.debug(f"Attempting to parse JSON: {json_string[:200]}...")
-        data = json.loads(json_string)
-        # Ensure the result is always a list
-        if isinstance(data, list):
-            logger.info(f"Successfully parsed agent response into a list of {len(data)} items.")
-            parse_span.set_attribute("app.parsed_item_count", len(data)) # If span added
+        try:
+            data = decode_json_from_string(raw_response)
+            if data is None:
+                st.error("Could not extract valid JSON data from the agent's response.")
+                # Log records are exported to Azure Monitor: the full text is only logged in debug mode
+                logger.error("Failed to extract JSON from the agent's response (%s characters).", len(raw_response or ""))
+                logger.debug("Response without JSON: %s", raw_response)
+                parse_span.set_status(Status(StatusCode.ERROR, "JSON extraction failed"))
+                if DEBUG_LOGGING:
+                    parse_span.set_attribute("app.raw_response_preview", (raw_response or "")[:200])
+                return None
+            # Ensure the result is always a list
+            if isinstance(data, dict):
+                logger.info("Parsed agent response into a single dictionary, wrapping in a list.")
+                data = [data]
+            # Check the shape once so the results view can rely on the expected fields
+            _validate_results(data)
+            logger.info("Successfully parsed agent response into a list of %s items.", len(data))
+            parse_span.set_attribute("app.parsed_item_count", len(data))
             return data
-        elif isinstance(data, dict):
-            logger.info("Successfully parsed agent response into a single dictionary, wrapping in a list.")
-            parse_span.set_attribute("app.parsed_item_count", 1) # If span added
-            return [data]
-        else:
-            logger.error(f"Parsed JSON is not a list or dictionary, type: {type(data)}")
+        except fastjsonschema.JsonSchemaException as e:
+            logger.error("Agent response does not match the expected schema: %s", e.message)
             st.error("The agent returned data in an unexpected format.")
-            parse_span.set_status(Status(StatusCode.ERROR, f"Unexpected JSON type: {type(data)}")) # If span added
+            parse_span.set_status(Status(StatusCode.ERROR, f"Schema validation failed: {e.message}"))
             return None
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing JSON response: {e}", exc_info=True)
-        logger.error(f"Problematic JSON string: {json_string}")
-        st.error("Failed to parse the JSON data received from the agent.")
-        # if 'parse_span' in locals(): # If span added
-        #     parse_span.record_exception(e)
-        #     parse_span.set_status(Status(StatusCode.ERROR, "JSONDecodeError"))
-        return None
+        except json.JSONDecodeError as e:
+            logger.error("Error parsing JSON response: %s", e, exc_info=True)
+            logger.debug("Problematic agent response: %s", raw_response)
+            st.error("Failed to parse the JSON data received from the agent.")
+            parse_span.record_exception(e)
+            parse_span.set_status(Status(StatusCode.ERROR, "JSONDecodeError"))
+            return None
+        except Exception as e:
+            # Catch unexpected errors during parsing/processing
+            logger.error("Unexpected error processing agent response: %s", e, exc_info=True)
+            st.error("An unexpected error occurred while processing the agent's response.")
+            parse_span.record_exception(e)
+            parse_span.set_status(Status(StatusCode.ERROR, f"Unexpected parsing error: {type(e).__name__}"))
+            return None
+
+def reset_agent_thread() -> None:
+    """Deletes the conversation thread of the current session, if any."""
+    thread = st.session_state.get("agent_thread")
+    st.session_state.agent_thread = None
+    if thread is None:
+        return
+    try:
+        _run_coroutine(thread.delete(), timeout=AGENT_CALL_TIMEOUT)
+        logger.info("Agent conversation thread deleted.")
     except Exception as e:
-        # Catch unexpected errors during parsing/processing
-        logger.error(f"Unexpected error processing agent response: {e}", exc_info=True)
-        st.error("An unexpected error occurred while processing the agent's response.")
-        # if 'parse_span' in locals(): # If span added
-        #     parse_span.record_exception(e)
-        #     parse_span.set_status(Status(StatusCode.ERROR, f"Unexpected parsing error: {type(e).__name__}"))
+        logger.warning("Could not delete agent conversation thread: %s", e)
+
+
+class _InflightCall:
+    """
+    An agent call shared by every request for the same notes, with the session that started it
+    and the number of requests still waiting on it.
+    """
+
+    def __init__(self, task: asyncio.Task, session_id: str):
+        self.task = task
+        self.session_id = session_id
+        self.waiters = 0
+
+
+@st.cache_resource(show_spinner=False)
+def _inflight_requests() -> dict[tuple[str, str | None], _InflightCall]:
+    """
+    Agent calls in progress, keyed by notes digest and thread ID. Only touched from the event loop thread.
+    """
+    return {}
+
+
+async def _run_agent_coalesced(
+    key: tuple[str, str | None],
+    inflight: dict[tuple[str, str | None], _InflightCall],
+    user_input: str,
+    agent_future: concurrent.futures.Future,
+    thread: AzureAIAgentThread | None,
+    session_id: str,
+    on_chunk: Callable[[str], None],
+) -> tuple[str, AzureAIAgentThread | None]:
+    """
+    Runs the agent, sharing a single call between concurrent requests for the same notes
+    in the same conversation: the key holds the thread ID, so only requests without a thread
+    are shared across sessions. A request that joins a call already in flight gets the whole
+    response as one chunk. In the same conversation, usually a rerun of the session that
+    started the call, it continues the thread the call created or extended; a request from
+    another session keeps its own. The call is cancelled once every request waiting on it is.
+    """
+    call = inflight.get(key)
+    leader = call is None
+    if leader:
+        call = _InflightCall(asyncio.ensure_future(run_agent(user_input, agent_future, thread, on_chunk)), session_id)
+        call.task.add_done_callback(lambda _: inflight.pop(key, None))
+        inflight[key] = call
+    else:
+        logger.info("Joining the in-flight agent request for identical notes and thread.")
+
+    call.waiters += 1
+    try:
+        response_content, call_thread = await asyncio.shield(call.task)
+    finally:
+        call.waiters -= 1
+        if call.waiters == 0 and not call.task.done():
+            logger.info("Cancelling the agent request: no session is waiting for it anymore.")
+            call.task.cancel()
+
+    if leader:
+        return response_content, call_thread
+    on_chunk(response_content)
+    if thread is not None or call.session_id == session_id:
+        return response_content, call_thread
+    return response_content, thread
+
+
+def notes_digest(user_input: str) -> str:
+    """Returns the SHA-256 hex digest identifying a note text in the caches."""
+    return hashlib.sha256(user_input.encode("utf-8")).hexdigest()
+
+
+class _SessionRequest:
+    """
+    The session state an analysis reads and reports back: the session, the conversation thread
+    to continue and the future of the call. Read on the script thread, so the event loop never
+    touches st.session_state.
+    """
+
+    def __init__(self, session_id: str, thread: AzureAIAgentThread | None):
+        self.session_id = session_id
+        self.thread = thread
+        self.future: concurrent.futures.Future | None = None
+
+
+def iter_agent_response(user_input: str, digest: str, request: _SessionRequest) -> Iterator[str]:
+    """
+    Runs the agent on the shared event loop and yields its answer as it streams in.
+    The thread the answer belongs to is stored on the request so follow-up notes reuse it.
+
+    Args:
+        user_input: The text input from the user.
+        digest: notes_digest of user_input, used to coalesce identical in-flight requests.
+        request: Thread to continue; receives the call's future and the resulting thread.
+
+    Yields:
+        Chunks of the agent's raw response.
+
+    Raises:
+        AgentCallError: If the agent call fails.
+    """
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _run_agent_coalesced(
+            (digest, request.thread.id if request.thread is not None else None),
+            _inflight_requests(),
+            user_input,
+            get_agent_future(),
+            request.thread,
+            request.session_id,
+            chunks.put,
+        ),
+        _get_event_loop(),
+    )
+    request.future = future
+    future.add_done_callback(lambda _: chunks.put(_STREAM_END))
+    while True:
+        try:
+            chunk = chunks.get(timeout=AGENT_STREAM_STALL_TIMEOUT)
+        except queue.Empty:
+            # Backstop in case the event loop stops delivering; run_agent enforces the call timeout itself
+            future.cancel()
+            logger.error("No response chunk received from the event loop for %s seconds.", AGENT_STREAM_STALL_TIMEOUT)
+            raise AgentCallError("The request to the AI agent timed out. Please try again.")
+        if chunk is _STREAM_END:
+            break
+        yield chunk
+    try:
+        _, request.thread = future.result()
+    except concurrent.futures.CancelledError:
+        # run_agent converts its own failures; only a cancellation reaches here unconverted
+        raise AgentCallError("The request to the AI agent was cancelled. Please try again.") from None
+
+
+class _StreamedRowsParser:
+    """
+    Incrementally parses the items of the top-level JSON array of a streamed response,
+    so each code can be shown as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self._rows = ijson.sendable_list()
+        self._parser = ijson.items_coro(self._rows, "item", use_float=True)
+        self._started = False
+        self._failed = False
+
+    def feed(self, chunk: str) -> list:
+        """
+        Feeds the next chunk of the response.
+
+        Returns:
+            The array items completed by this chunk.
+        """
+        if self._failed:
+            return []
+        if not self._started:
+            # Skip a leading ```json fence or any text before the array
+            start = chunk.find("[")
+            if start < 0:
+                return []
+            chunk = chunk[start:]
+            self._started = True
+        try:
+            self._parser.send(chunk.encode("utf-8"))
+        except ijson.JSONError:
+            # A closing fence or malformed JSON: stop the preview, parse_agent_response reports errors
+            self._failed = True
+        rows = list(self._rows)
+        del self._rows[:]
+        return rows
+
+
+def _fetch_agent_response(user_input: str, digest: str, request: _SessionRequest) -> list | None:
+    """
+    Streams the agent's response, showing each suggested code as it arrives, then parses it.
+
+    Args:
+        user_input: The text input from the user.
+        digest: notes_digest of user_input.
+        request: See iter_agent_response.
+
+    Returns:
+        A list containing the parsed data from the agent, or None if an error occurs.
+    """
+    stream_placeholder = st.empty()
+    rows_parser = _StreamedRowsParser()
+    streamed_rows = []
+    raw_parts = []
+    try:
+        for chunk in iter_agent_response(user_input, digest, request):
+            raw_parts.append(chunk)
+            new_rows = rows_parser.feed(chunk)
+            if new_rows:
+                streamed_rows.extend(new_rows)
+                stream_placeholder.dataframe(
+                    [{column: row.get(column) for column in ("code", "description", "extract")}
+                     for row in streamed_rows if isinstance(row, dict)],
+                    hide_index=True,
+                )
+    except AgentCallError as e:
+        # Errors are logged and traced in run_agent; Streamlit calls must stay on the script thread.
+        st.error(str(e))
         return None
+    finally:
+        # The preview is only shown while the response streams in; the results editor replaces it
+        stream_placeholder.empty()
+    return parse_agent_response("".join(raw_parts))
+
+
+# Successful analyses are reused for an hour, for at most this many note texts and conversations
+ANALYSIS_CACHE_TTL = 3600.0  # seconds
+ANALYSIS_CACHE_MAX_ENTRIES = 128
+
+
+class _AnalysisCache:
+    """
+    Successful analyses keyed by notes digest and conversation thread ID, shared by every session.
+
+    The thread ID stays the same as the conversation grows, so resubmitting notes later in a
+    conversation returns the answer they got the first time, even if other notes were sent in
+    between. This is intended: the codes for a note don't depend on the notes sent after it.
+    Sessions without a thread share entries. Script threads run concurrently, hence the lock.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[tuple[str, str | None], tuple[float, list]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, str | None]) -> list | None:
+        """Returns the cached analysis, or None if there is none or it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, results = entry
+            if time.monotonic() - stored_at > ANALYSIS_CACHE_TTL:
+                del self._entries[key]
+                return None
+            return results
+
+    def put(self, key: tuple[str, str | None], results: list) -> None:
+        """Stores an analysis, evicting the oldest entry past ANALYSIS_CACHE_MAX_ENTRIES."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > ANALYSIS_CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def _analysis_cache() -> _AnalysisCache:
+    """Returns the process-wide cache of analyses. Entries are shared, so they must not be mutated."""
+    return _AnalysisCache()
+
 
 def get_agent_response_sync(user_input: str) -> list | None:
-    """Synchronous wrapper for the async agent call."""
-    # This runs the async function in the current event loop (managed by nest_asyncio)
-    return asyncio.run(get_agent_response_async(user_input))
+    """
+    Returns the agent's analysis of the notes.
+    Notes analyzed within the last hour are answered from the cache without calling Azure:
+    a first request from any session, or a resubmission in the conversation they were analyzed in.
+
+    Args:
+        user_input: The text input from the user.
+
+    Returns:
+        A list containing the parsed data from the agent, or None if an error occurs.
+    """
+    digest = notes_digest(user_input)
+    # A rerun abandons the script run that was waiting on this session's previous request.
+    # Stop that request, unless it is for the same notes: this run joins it instead.
+    previous = st.session_state.get("agent_request")
+    if previous is not None and previous[0] != digest and previous[1].cancel():
+        # Cancelling only stops the client side: the run goes on in Azure, and its thread rejects
+        # new messages while a run is active. Deleting the thread ends it; the next call starts a new one.
+        reset_agent_thread()
+
+    request = _SessionRequest(st.session_state.session_id, st.session_state.get("agent_thread"))
+    thread_id = request.thread.id if request.thread is not None else None
+    cache = _analysis_cache()
+    results = cache.get((digest, thread_id))
+    if results is not None:
+        # Nothing is sent, and the session keeps its thread
+        return results
+    try:
+        results = _fetch_agent_response(user_input, digest, request)
+    finally:
+        # Also runs when a rerun interrupts the stream, so the next run can cancel the call
+        if request.future is not None:
+            st.session_state.agent_request = (digest, request.future)
+        st.session_state.agent_thread = request.thread
+    if results is not None:
+        cache.put((digest, thread_id), results)
+        # The answer was added to the session's thread: resubmitting the notes there is a hit
+        if request.thread is not None and request.thread.id != thread_id:
+            cache.put((digest, request.thread.id), results)
+    return results # None: error already shown by _fetch_agent_response
 
 # --- Streamlit UI ---
 
+# Fields of a suggested code, in display order
+RESULT_COLUMNS = ["extract", "description", "code", "url"]
+
+
+def to_display_url(idx: int, url) -> str | None:
+    """
+    Returns an absolute link for a result row, or None if the URL is unusable.
+
+    Args:
+        idx: Index of the row, used for logging.
+        url: The URL returned by the agent.
+    """
+    if url and isinstance(url, str) and (url.startswith(('http://', 'https://')) or url.startswith('www.')):
+        # Ensure URL is absolute if it starts with www.
+        return f"https://{url}" if url.startswith('www.') else url
+    if url: # Log if a URL was present but invalid
+        logger.warning("Row %s has an invalid or missing URL: '%s'", idx, url)
+    return None
+
+
+@contextmanager
+def profile_analysis() -> Iterator[None]:
+    """
+    Profiles the enclosed block with pyinstrument when HARMATTAN_PROFILE is set, and shows
+    the report in the sidebar. Only the script thread is sampled: time spent on the agent
+    call shows up as waiting in iter_agent_response, parsing and rendering as their own frames.
+    """
+    if not PROFILE_ANALYSIS:
+        yield
+        return
+    # Development-only dependencies, deliberately not in requirements.txt
+    from pyinstrument import Profiler
+    import streamlit.components.v1 as components
+
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+    logger.info("Analysis profile:\n%s", profiler.output_text())
+    with st.sidebar.expander("⏱️ Analysis profile", expanded=False):
+        components.html(profiler.output_html(), height=600, scrolling=True)
+
+
 
 @st.dialog("Recap", width="large")
 def show_validation_dialog(validated_data: list[dict], system_name: str):
@@ -336,15 +933,21 @@ def show_validation_dialog(validated_data: list[dict], system_name: str):
     st.write(f"Codes selected for sending to **{system_name}**:")
     if validated_data:
         # Extract only the 'code' field for display in the table
-        codes_to_display = [{'Code': row.get('code', 'N/A')} for row in validated_data]
-        df = pd.DataFrame(codes_to_display)
-        st.table(df)
+        st.table({"Code": [row.get('code', 'N/A') for row in validated_data]})
         # You might want to add logic here to actually *send* the data
         st.success("Data ready for transmission (implementation pending).")
-        logger.info(f"{len(validated_data)} codes validated for system {system_name}.")
+        logger.info("%s codes validated for system %s.", len(validated_data), system_name)
     else:
         st.warning("No codes were selected for validation.")
-        logger.info(f"Validation dialog shown for system {system_name}, but no codes were selected.")
+        logger.info("Validation dialog shown for system %s, but no codes were selected.", system_name)
+
+LOGO_PATH = "assets/logo_harmattan.png"
+
+
+@st.cache_resource(show_spinner=False)
+def _load_logo_bytes() -> bytes:
+    """Reads the logo once per process instead of from disk on every rerun."""
+    return pathlib.Path(LOGO_PATH).read_bytes()
 
 # Inject minimal CSS for button styling
 st.markdown(
@@ -365,12 +968,76 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+def build_result_rows(results: list[dict]) -> list[dict]:
+    """
+    Builds the rows shown in the results editor.
+    Not cached: hashing and copying the payload would cost more than building a few records.
+
+    Args:
+        results: The parsed agent response.
+
+    Returns:
+        One record per code with the result columns, a display URL and an unchecked Validate flag.
+    """
+    # Known schema: keep only the displayed fields
+    return [
+        {
+            "extract": row.get("extract"),
+            "description": row.get("description"),
+            "code": row.get("code"),
+            "url": to_display_url(idx, row.get("url")),
+            "validate": False,
+        }
+        for idx, row in enumerate(results)
+    ]
+
+@st.fragment
+def render_results(system_name: str):
+    """
+    Renders the results editor and the save action for the current analysis.
+    Runs as a fragment: saving validations only reruns this block, not the whole script.
+
+    Args:
+        system_name: The name of the system selected in the sidebar.
+    """
+    # parse_agent_response validated the shape: a list of objects with the expected fields
+    result_rows = build_result_rows(st.session_state.agent_response_data)
+
+    with st.form(key="validation_form"):
+        # One editor for the whole table instead of a row of widgets per code
+        # A list of records comes back from the editor as a list of records
+        edited_rows = st.data_editor(
+            result_rows,
+            column_config={
+                "extract": st.column_config.TextColumn("Excerpt", width="large"),
+                "description": st.column_config.TextColumn("Description", width="large"),
+                "code": st.column_config.TextColumn("Code"),
+                "url": st.column_config.LinkColumn("Link", display_text="Link"),
+                "validate": st.column_config.CheckboxColumn("Validate", default=False),
+            },
+            column_order=[*RESULT_COLUMNS, "validate"],
+            disabled=RESULT_COLUMNS,
+            hide_index=True,
+            key="validation_editor",
+        )
+
+        submitted = st.form_submit_button("Save Validated Codes")
+        if submitted:
+            logger.info("Save Validated Codes button clicked.")
+            validated_rows_data = [
+                {column: row[column] for column in RESULT_COLUMNS}
+                for row in edited_rows if row["validate"]
+            ]
+
+            logger.debug("Data prepared for validation dialog: %s", validated_rows_data)
+            show_validation_dialog(validated_data=validated_rows_data, system_name=system_name)
+
 # --- Sidebar ---
 # Ensure asset path is correct or handle potential FileNotFoundError
 try:
-    st.sidebar.image("assets/logo_harmattan.png", width=250) # Adjust width as needed
+    st.sidebar.image(_load_logo_bytes(), width=250) # Adjust width as needed
 except FileNotFoundError:
-    st.sidebar.warning("Logo image not found at assets/logo_harmattan.png")
+    st.sidebar.warning(f"Logo image not found at {LOGO_PATH}")
 except Exception as e: # Catch other potential errors from st.image, like UnidentifiedImageError
     st.sidebar.warning(f"Could not load logo: {e}")
 
@@ -381,6 +1048,12 @@ system_selection = st.sidebar.selectbox(
     key="system_selection" # Add key for stability
 )
 
+if st.sidebar.button("New conversation", key="new_conversation_button"):
+    # The agent thread is only deleted on request, so follow-up notes keep their context
+    reset_agent_thread()
+    st.session_state.agent_response_data = None
+    st.session_state.pop("validation_editor", None)
+
 # Authentication check and user info in sidebar
 if st.user.is_logged_in:
     with st.sidebar.expander(f"👤 User: {st.user.name}", expanded=False):
@@ -390,21 +1063,24 @@ if st.user.is_logged_in:
         if st.button("Logout", key="logout_button"):
              st.logout() # Use Streamlit's built-in logout
 else:
-    st.sidebar.button("Login", on_click=st.login("auth0"), key="login_button") # Use Streamlit's built-in login
+    # Pass st.login as the callback so it only runs on click, not on every rerun
+    st.sidebar.button("Login", on_click=st.login, args=("auth0",), key="login_button") # Use Streamlit's built-in login
 
 # --- Main Application Area ---
 
 # Initialize session state for agent response if it doesn't exist
 if "agent_response_data" not in st.session_state:
     st.session_state.agent_response_data = None # Store the parsed list here
-if "validation_states" not in st.session_state:
-    st.session_state.validation_states = {} # Store checkbox states {index: bool}
+if "agent_thread" not in st.session_state:
+    st.session_state.agent_thread = None # Agent conversation thread reused across analyses
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex # Tells this session's in-flight agent calls apart
 
 # Ensure asset path is correct or handle potential FileNotFoundError
 try:
-    st.image("assets/logo_harmattan.png", width=500) # Adjust width as needed
+    st.image(_load_logo_bytes(), width=500) # Adjust width as needed
 except FileNotFoundError:
-    st.warning("Main logo image not found at assets/logo_harmattan.png")
+    st.warning(f"Main logo image not found at {LOGO_PATH}")
 except Exception as e:
     st.warning(f"Could not load main logo: {e}")
 
@@ -415,24 +1091,27 @@ doctor_notes = st.text_area("Doctor's Notes:", height=200, key="doctor_notes_inp
 
 # Main action button - only enabled if logged in
 if st.user.is_logged_in:
+    # Start connecting to the agent while the notes are being typed. This does not wait,
+    # and does not retry a failed attempt: the Analyze click does that via get_agent_future.
+    _create_agent_future()
     if st.button("Analyze Notes", key="analyze_button", type="primary"):
-        if doctor_notes.strip():
-            with st.spinner("Sending request to Harmattan AI... Please wait.",show_time=True):
-                logger.info(f"Analyze button clicked, processing notes for system: {system_selection}.") # Added system_selection to log
+        if doctor_notes and not doctor_notes.isspace():
+            with profile_analysis(), st.spinner("Sending request to Harmattan AI... Please wait.",show_time=True):
+                logger.info("Analyze button clicked, processing notes for system: %s.", system_selection) # Added system_selection to log
                 # Call the synchronous wrapper which handles the async call
                 response_data = get_agent_response_sync(doctor_notes)
                 st.session_state.agent_response_data = response_data # Store results or None
-                # Reset validation states when new results are fetched
-                st.session_state.validation_states = {}
+                # Reset validation checkboxes when new results are fetched
+                st.session_state.pop("validation_editor", None)
                 if response_data is None:
                     logger.warning("Agent analysis resulted in an error or no data.")
-                    # Error message already shown by get_agent_response_async/run_agent
+                    # Error message already shown by _fetch_agent_response or parse_agent_response
                 elif not response_data:
                     st.info("The analysis did not return any specific codes for the provided notes.")
                     logger.info("Agent analysis completed but returned an empty list.")
                 else:
                     st.success(f"Analysis complete. Found {len(response_data)} potential codes.")
-                    logger.info(f"Agent analysis successful, {len(response_data)} items returned.")
+                    logger.info("Agent analysis successful, %s items returned.", len(response_data))
         else:
             st.warning("Please paste the doctor's notes into the text area before analyzing.")
             logger.warning("Analyze button clicked, but input notes were empty.")
@@ -444,66 +1123,7 @@ st.markdown("---") # Visual separator
 st.subheader("Analysis Results")
 
 if st.session_state.agent_response_data:
-    results = st.session_state.agent_response_data
-    # Ensure results is a list of dicts for DataFrame compatibility
-    if not all(isinstance(item, dict) for item in results):
-        st.error("Agent response data is not in the expected format (list of dictionaries).")
-        logger.error(f"Agent response data malformed: {results}")
-    else:
-        df_resp = pd.DataFrame(results)
-
-        with st.form(key="validation_form"):
-            # Headers outside the loop
-            # Adjusted column widths for better layout
-            cols_header = st.columns([4, 3, 2, 1, 1]) # Excerpt, Description, Code, Link, Check
-            cols_header[0].markdown("**Excerpt**")
-            cols_header[1].markdown("**Description**")
-            cols_header[2].markdown("**Code**")
-            cols_header[3].markdown("**Link**")
-            cols_header[4].markdown("**Validate**") # Changed from "Check" to "Validate" for clarity
-            st.markdown("---") # Separator after headers
-
-            for idx, row in df_resp.iterrows():
-                # Match header column widths
-                cols = st.columns([4.5,4,1.5,1.5,1.5])
-
-                cols[0].text(row.get('extract', 'N/A'))
-                cols[1].text(row.get('description', 'N/A'))
-                cols[2].text(row.get('code', 'N/A'))
-
-                url = row.get('url')
-                if url and isinstance(url, str) and (url.startswith(('http://', 'https://')) or url.startswith('www.')):
-                    # Ensure URL is absolute if it starts with www.
-                    display_url = f"https://{url}" if url.startswith('www.') else url
-                    cols[3].link_button("Link", display_url, help=f"Open link for code {row.get('code', '')}")
-                else:
-                    cols[3].text("-")
-                    if url: # Log if a URL was present but invalid
-                        logger.warning(f"Row {idx} has an invalid or missing URL: '{url}'")
-
-                validation_key = f"validate_{idx}"
-                # Default to False if key not in validation_states
-                current_validation_state = st.session_state.validation_states.get(validation_key, False)
-                is_validated = cols[4].checkbox(
-                    "", # Removed label as header "Validate" serves this purpose
-                    key=validation_key,
-                    value=current_validation_state,
-                    label_visibility="hidden"
-                )
-                st.session_state.validation_states[validation_key] = is_validated
-                st.markdown("---")
-
-            submitted = st.form_submit_button("Save Validated Codes")
-            if submitted:
-                logger.info("Save Validated Codes button clicked.")
-                validated_rows_data = []
-                for i, r_series in df_resp.iterrows(): # r_series is a pandas Series
-                    # Use the persisted checkbox state from st.session_state.validation_states
-                    if st.session_state.validation_states.get(f"validate_{i}", False):
-                        validated_rows_data.append(r_series.to_dict())
-
-                logger.debug(f"Data prepared for validation dialog: {validated_rows_data}")
-                show_validation_dialog(validated_data=validated_rows_data, system_name=system_selection)
+    render_results(system_selection)
 
 elif st.session_state.agent_response_data is None and st.user.is_logged_in:
      # Only show this if logged in and no analysis has been run yet or failed